@@ -0,0 +1,121 @@
+import csv
+import os
+import time
+import logging
+from collections import defaultdict
+import gevent
+import psycopg2
+from utils import APPLICATION_NAME
+
+logger = logging.getLogger(__name__)
+
+# The sampler uses its own application_name so it never samples (or terminates) itself
+SAMPLER_APPLICATION_NAME = "zersql-sampler"
+
+# Samples are averaged into buckets of this many seconds, like Performance Insights' AAS charts
+BUCKET_SECONDS = 5
+
+ACTIVITY_QUERY = """
+SELECT
+    CASE
+        WHEN EXISTS (SELECT 1 FROM pg_locks l WHERE l.pid = a.pid AND NOT l.granted) THEN 'Lock'
+        WHEN a.wait_event_type IS NULL THEN 'CPU'
+        ELSE a.wait_event_type
+    END AS wait_class,
+    a.query
+FROM pg_stat_activity a
+WHERE a.application_name = %s
+  AND a.state = 'active'
+  AND a.pid <> pg_backend_pid()
+"""
+
+
+class ActivitySampler:
+    """Polls pg_stat_activity/pg_locks during a run and aggregates average active sessions."""
+
+    def __init__(self, credentials, queries, interval=0.5):
+        self.credentials = credentials
+        self.interval = interval
+        # Query text -> file name, to attribute sessions to the query file they run
+        self.query_files = {text.strip(): filename for filename, text in queries}
+        self.active_sessions = defaultdict(int)  # (bucket, wait class, query) -> session samples
+        self.sample_counts = defaultdict(int)    # bucket -> number of samples taken
+        self.greenlet = None
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill(block=True)
+            self.greenlet = None
+
+    def run(self):
+        try:
+            connection = psycopg2.connect(
+                host=self.credentials['host'],
+                dbname=self.credentials['dbname'],
+                user=self.credentials['username'],
+                password=self.credentials['password'],
+                port=self.credentials['port'],
+                application_name=SAMPLER_APPLICATION_NAME
+            )
+        except Exception:
+            logger.exception("Could not connect the database activity sampler")
+            return
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                while True:
+                    try:
+                        cursor.execute(ACTIVITY_QUERY, (APPLICATION_NAME,))
+                        self.record(time.time(), cursor.fetchall())
+                    except Exception:
+                        logger.exception("Error sampling database activity")
+                    gevent.sleep(self.interval)
+        finally:
+            connection.close()
+
+    def record(self, timestamp, rows):
+        bucket = int(timestamp // BUCKET_SECONDS * BUCKET_SECONDS)
+        self.sample_counts[bucket] += 1
+        for wait_class, query in rows:
+            self.active_sessions[(bucket, wait_class, self.query_file(query))] += 1
+
+    def query_file(self, query):
+        query = (query or "").strip()
+        if query in self.query_files:
+            return self.query_files[query]
+        # pg_stat_activity truncates long statements to track_activity_query_size
+        if query:
+            for text, filename in self.query_files.items():
+                if text.startswith(query):
+                    return filename
+        return "other"
+
+    def rows(self):
+        """Returns the aggregated time series, one row per bucket, wait class and query file.
+
+        Buckets sampled with no active sessions get a single row with empty wait
+        class and query, so idle periods still count towards run-level averages.
+        """
+        rows = [
+            {
+                "Timestamp": bucket,
+                "Wait Class": wait_class,
+                "Query": query,
+                "Average Active Sessions": round(count / self.sample_counts[bucket], 3),
+            }
+            for (bucket, wait_class, query), count in self.active_sessions.items()
+        ]
+        busy_buckets = {bucket for bucket, _, _ in self.active_sessions}
+        for bucket in self.sample_counts:
+            if bucket not in busy_buckets:
+                rows.append({"Timestamp": bucket, "Wait Class": "", "Query": "", "Average Active Sessions": 0})
+        return sorted(rows, key=lambda row: (row["Timestamp"], row["Wait Class"], row["Query"]))
+
+    def save(self, path):
+        with open(path, mode='w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=["Timestamp", "Wait Class", "Query", "Average Active Sessions"])
+            writer.writeheader()
+            writer.writerows(self.rows())
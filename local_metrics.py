@@ -0,0 +1,202 @@
+import os
+import time
+import logging
+from datetime import datetime, timezone
+import gevent
+import psycopg2
+from utils import get_aws_client
+
+logger = logging.getLogger(__name__)
+
+# The collector's own connection, kept apart from the load-test backends
+COLLECTOR_APPLICATION_NAME = "zersql-metrics"
+
+# Storage the local stand-in pretends to have allocated, matching init-localstack.sh (20GB)
+ALLOCATED_STORAGE_BYTES = int(float(os.environ.get("LOCAL_ALLOCATED_STORAGE_GB", "20")) * 1024**3)
+
+# Container CPU usage as seen from inside Postgres: cgroup v2 (microseconds) and v1 (nanoseconds)
+CGROUP_CPU_FILES = [
+    ("/sys/fs/cgroup/cpu.stat", 1e-6),
+    ("/sys/fs/cgroup/cpuacct/cpuacct.usage", 1e-9),
+    ("/sys/fs/cgroup/cpu,cpuacct/cpuacct.usage", 1e-9),
+]
+
+# CPUs available to the Postgres container: a quota (cgroup v2, then v1), else its cpuset
+CGROUP_CPU_MAX_FILE = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_QUOTA_FILES = ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+CGROUP_CPUSET_FILES = ["/sys/fs/cgroup/cpuset.cpus.effective", "/sys/fs/cgroup/cpuset/cpuset.effective_cpus"]
+
+COUNTERS_QUERY = """
+SELECT
+    (SELECT count(*) FROM pg_stat_activity WHERE backend_type = 'client backend'),
+    (SELECT count(*) FROM pg_stat_activity WHERE backend_type = 'client backend' AND state = 'active'),
+    (SELECT sum(blks_read) FROM pg_stat_database),
+    (SELECT buffers_checkpoint + buffers_clean + buffers_backend FROM pg_stat_bgwriter),
+    (SELECT sum(pg_database_size(datname)) FROM pg_database)
+"""
+
+
+def parse_cpu_seconds(content, scale):
+    """Reads total CPU time in seconds from a cgroup v2 cpu.stat or v1 cpuacct.usage file."""
+    for line in content.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == "usage_usec":
+            return int(parts[1]) * scale
+        if len(parts) == 1:
+            return int(parts[0]) * scale
+    return None
+
+
+def parse_cpu_max(content):
+    """Reads the CPU count from a cgroup v2 cpu.max ('200000 100000'), or None if unlimited."""
+    parts = content.split()
+    if len(parts) != 2 or parts[0] == "max":
+        return None
+    return int(parts[0]) / int(parts[1])
+
+
+def parse_cpuset(content):
+    """Counts the CPUs in a cpuset list such as '0-3,6'."""
+    count = 0
+    for part in content.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            count += int(last) - int(first) + 1
+        elif part:
+            count += 1
+    return count or None
+
+
+class LocalMetricsPublisher:
+    """Derives RDS-style CloudWatch metrics from the local Postgres and publishes them to LocalStack."""
+
+    def __init__(self, credentials, instance_id, interval=10, flush_every=3):
+        self.credentials = credentials
+        self.instance_id = instance_id
+        self.interval = interval
+        self.flush_every = flush_every
+        self.cpu_count = None
+        self.cpu_file = None
+        self.previous = None
+        self.buffer = []
+        self.greenlet = None
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill(block=True)
+            self.greenlet = None
+
+    def run(self):
+        client = get_aws_client('cloudwatch')
+        connection = psycopg2.connect(
+            host=self.credentials['host'],
+            dbname=self.credentials['dbname'],
+            user=self.credentials['username'],
+            password=self.credentials['password'],
+            port=self.credentials['port'],
+            application_name=COLLECTOR_APPLICATION_NAME
+        )
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                while True:
+                    try:
+                        self.buffer.extend(self.collect(cursor))
+                    except Exception:
+                        logger.exception("Error collecting local database metrics")
+                    if len(self.buffer) >= self.flush_every * 5:
+                        self.flush(client)
+                    gevent.sleep(self.interval)
+        finally:
+            # Publish whatever was collected before the run stopped
+            self.flush(client)
+            connection.close()
+
+    def read_server_file(self, cursor, path):
+        """Reads a file on the database server, or returns None if it's missing or not allowed."""
+        try:
+            cursor.execute("SELECT pg_read_file(%s)", (path,))
+            return cursor.fetchone()[0]
+        except psycopg2.Error:
+            return None
+
+    def read_cpu_count(self, cursor):
+        """Returns the CPUs available to the Postgres container, read from its own cgroup."""
+        content = self.read_server_file(cursor, CGROUP_CPU_MAX_FILE)
+        cpu_count = parse_cpu_max(content) if content else None
+        if cpu_count is None:
+            quota, period = (self.read_server_file(cursor, path) for path in CGROUP_V1_QUOTA_FILES)
+            if quota and period and int(quota) > 0:
+                cpu_count = int(quota) / int(period)
+        for path in CGROUP_CPUSET_FILES:
+            if cpu_count is not None:
+                break
+            content = self.read_server_file(cursor, path)
+            cpu_count = parse_cpuset(content) if content else None
+        # Without access to the server's cgroup, assume Postgres runs on the same
+        # Docker host as Locust (true for docker-compose) and shares its CPUs.
+        return cpu_count or os.cpu_count() or 1
+
+    def read_cpu_seconds(self, cursor):
+        """Returns the Postgres container's CPU time, or None if cgroup stats can't be read."""
+        candidates = [self.cpu_file] if self.cpu_file else CGROUP_CPU_FILES
+        for path, scale in candidates:
+            content = self.read_server_file(cursor, path)
+            cpu_seconds = parse_cpu_seconds(content, scale) if content else None
+            if cpu_seconds is not None:
+                self.cpu_file = (path, scale)
+                return cpu_seconds
+        return None
+
+    def collect(self, cursor):
+        """Takes one sample and returns the metric datums for it (none for the first sample)."""
+        now = time.time()
+        cursor.execute(COUNTERS_QUERY)
+        connections, active, blocks_read, blocks_written, used_bytes = cursor.fetchone()
+        cpu_seconds = self.read_cpu_seconds(cursor)
+        if self.cpu_count is None:
+            self.cpu_count = self.read_cpu_count(cursor)
+
+        current = (now, int(blocks_read or 0), int(blocks_written or 0), cpu_seconds)
+        previous, self.previous = self.previous, current
+        if previous is None:
+            return []
+
+        elapsed = max(now - previous[0], 1e-3)
+        if cpu_seconds is not None and previous[3] is not None:
+            cpu_percent = (cpu_seconds - previous[3]) / (elapsed * self.cpu_count) * 100
+        else:
+            # Without cgroup access, approximate CPU by active backends per core
+            cpu_percent = active / self.cpu_count * 100
+
+        timestamp = datetime.fromtimestamp(now, tz=timezone.utc)
+        values = [
+            ('CPUUtilization', min(max(cpu_percent, 0), 100), 'Percent'),
+            ('DatabaseConnections', connections, 'Count'),
+            ('ReadIOPS', max(current[1] - previous[1], 0) / elapsed, 'Count/Second'),
+            ('WriteIOPS', max(current[2] - previous[2], 0) / elapsed, 'Count/Second'),
+            ('FreeStorageSpace', max(ALLOCATED_STORAGE_BYTES - int(used_bytes or 0), 0), 'Bytes'),
+        ]
+        return [
+            {
+                'MetricName': metric_name,
+                'Dimensions': [{'Name': 'DBInstanceIdentifier', 'Value': self.instance_id}],
+                'Timestamp': timestamp,
+                'Value': float(value),
+                'Unit': unit
+            }
+            for metric_name, value, unit in values
+        ]
+
+    def flush(self, client):
+        """Publishes buffered datums in as few put_metric_data calls as possible."""
+        buffer, self.buffer = self.buffer, []
+        # put_metric_data accepts up to 1000 datums per call
+        for i in range(0, len(buffer), 1000):
+            try:
+                client.put_metric_data(Namespace='AWS/RDS', MetricData=buffer[i:i + 1000])
+            except Exception as e:
+                logger.warning(f"Error publishing local CloudWatch metrics: {e}")
@@ -1,45 +1,232 @@
 import time
 import os
+import logging
 import random
+import socket
+import gevent
+from gevent.socket import wait_read, wait_write
 from locust import User, task, between, events
+from locust.runners import WorkerRunner
 import psycopg2
-from utils import get_secret
+from psycopg2 import extensions
+from db_activity import ActivitySampler
+from local_metrics import LocalMetricsPublisher
+import metrics_exporter
+from utils import get_secret, get_targets, request_name, parse_query_timeouts, terminate_orphaned_backends, APPLICATION_NAME
 
+logger = logging.getLogger(__name__)
 
-class SqlUser(User):
-    wait_time = between(1, 5)
+# Global statement timeout in milliseconds (0 = no timeout), overridable per query file
+STATEMENT_TIMEOUT_MS = int(os.environ.get("STATEMENT_TIMEOUT_MS", "0"))
+QUERY_TIMEOUTS = parse_query_timeouts(os.environ.get("QUERY_TIMEOUTS"))
 
-    def on_start(self):
-        """ on_start is called when a Locust start before any task is scheduled """
-        credentials = get_secret()
+# Extra time the server gets to enforce statement_timeout before the client cancels
+CLIENT_TIMEOUT_GRACE_MS = 1000
+# How long to wait for the server to answer a cancel request before giving up on the connection
+CANCEL_DRAIN_TIMEOUT = 5
+
+# Seconds between pg_stat_activity samples (0 = sampler disabled)
+ACTIVITY_SAMPLE_INTERVAL = float(os.environ.get("ACTIVITY_SAMPLE_INTERVAL", "0.5"))
+
+# In LocalStack mode, publish CloudWatch metrics derived from the local Postgres every N seconds (0 = disabled)
+USE_LOCALSTACK = os.environ.get("USE_LOCALSTACK", "true").lower() == "true"
+LOCAL_METRICS_INTERVAL = float(os.environ.get("LOCAL_METRICS_INTERVAL", "10"))
+
+# Port for the OpenMetrics/Prometheus endpoint on the master (0 = disabled)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9646"))
+
+
+def load_queries():
+    """Loads (filename, sql) pairs from the 'queries' directory, limited to QUERIES_TO_RUN if set."""
+    queries = []
+    queries_to_run = os.environ.get("QUERIES_TO_RUN")
+    if queries_to_run:
+        selected_queries = queries_to_run.split(",")
+        for filename in selected_queries:
+            with open(os.path.join("queries", filename), 'r') as f:
+                queries.append((filename, f.read()))
+    else:
+        for filename in os.listdir("queries"):
+            if filename.endswith(".sql"):
+                with open(os.path.join("queries", filename), 'r') as f:
+                    queries.append((filename, f.read()))
+    return queries
+
+
+class CancelTimeoutError(psycopg2.OperationalError):
+    """The server didn't answer a cancel request in time; psycopg2 has closed the connection."""
+
+
+def cancel_backend(conn):
+    """Sends a cancel request from the hub's threadpool, since PQcancel blocks for a connect round trip."""
+    gevent.get_hub().threadpool.spawn(conn.cancel).get()
+
+
+def gevent_wait_callback(conn):
+    """Waits for psycopg2 I/O cooperatively so a slow query only blocks its own user."""
+    # psycopg2 closes the connection if this callback raises, so a client-side
+    # timeout cancels the statement and keeps polling (like extras.wait_select):
+    # execute() then raises QueryCanceledError on a connection that is still usable.
+    cancelled = False
+    while True:
+        try:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            wait_timeout = CANCEL_DRAIN_TIMEOUT if cancelled else None
+            if state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=wait_timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=wait_timeout)
+            else:
+                raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+        except gevent.Timeout:
+            cancel_backend(conn)
+            cancelled = True
+        except socket.timeout:
+            # Only reachable after a cancel: give up on the connection, but still report a timeout
+            raise CancelTimeoutError("Server did not answer the cancel request")
+        except gevent.GreenletExit:
+            # Test stop: the user is going away, but the server must stop working too
+            cancel_backend(conn)
+            raise
+
+
+extensions.set_wait_callback(gevent_wait_callback)
+
+
+activity_sampler = None
+metrics_publisher = None
+
+
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    """ Serve live metrics from the master; workers just report their gauges to it """
+    environment.events.request.add_listener(metrics_exporter.on_request)
+    if isinstance(environment.runner, WorkerRunner):
+        environment.events.report_to_master.add_listener(metrics_exporter.on_report_to_master)
+    elif METRICS_PORT > 0:
+        metrics_exporter.start_exporter(environment, METRICS_PORT)
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **kwargs):
+    """ Start the database collectors; only one process per run needs to do it """
+    global activity_sampler, metrics_publisher
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    # With several targets, the collectors watch the first one
+    credentials = get_secret(get_targets()[0][1])
+    if ACTIVITY_SAMPLE_INTERVAL > 0:
+        activity_sampler = ActivitySampler(credentials, load_queries(), interval=ACTIVITY_SAMPLE_INTERVAL)
+        activity_sampler.start()
+    if USE_LOCALSTACK and LOCAL_METRICS_INTERVAL > 0:
+        instance_id = os.environ.get("DB_INSTANCE_IDENTIFIER", "locust-rds-instance")
+        metrics_publisher = LocalMetricsPublisher(credentials, instance_id, interval=LOCAL_METRICS_INTERVAL)
+        metrics_publisher.start()
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    """ Stop the collectors, store the activity time series next to the Locust CSV stats and clean up backends """
+    global activity_sampler, metrics_publisher
+    if metrics_publisher is not None:
+        metrics_publisher.stop()
+        metrics_publisher = None
+    if activity_sampler is not None:
+        activity_sampler.stop()
+        csv_prefix = getattr(environment.parsed_options, "csv_prefix", None) or "stats"
+        activity_sampler.save(f"{csv_prefix}_activity.csv")
+        activity_sampler = None
+
+    # The users are stopped by now; make sure none of their backends outlives the
+    # test, even if a cancel request was lost. Workers may stop while others are
+    # still running, so only the master cleans up.
+    if isinstance(environment.runner, WorkerRunner):
+        return
+    for name, secret_name in get_targets():
+        try:
+            terminate_orphaned_backends(get_secret(secret_name))
+        except Exception as e:
+            logger.warning(f"Could not terminate orphaned backends on {name}: {e}")
+
+
+class DbTarget:
+    """One named database endpoint with the connection a simulated user holds to it."""
+
+    def __init__(self, name, credentials):
+        self.name = name
+        self.credentials = credentials
+        self.connect()
+
+    def connect(self):
+        credentials = self.credentials
         self.connection = psycopg2.connect(
             host=credentials['host'],
             dbname=credentials['dbname'],
             user=credentials['username'],
             password=credentials['password'],
-            port=credentials['port']
+            port=credentials['port'],
+            application_name=APPLICATION_NAME
         )
+        # Each query runs in its own transaction so a cancelled one doesn't poison the session
+        self.connection.autocommit = True
+        metrics_exporter.connection_opened(self.name)
         self.cursor = self.connection.cursor()
-        
+        self.statement_timeout_ms = None
+
+    def close(self):
+        self.cursor.close()
+        self.connection.close()
+        metrics_exporter.connection_closed(self.name)
+
+    def set_statement_timeout(self, timeout_ms):
+        """Applies the server-side statement_timeout, skipping the round trip if unchanged."""
+        # A cancel the server never answered leaves the connection closed by psycopg2
+        if self.connection.closed:
+            self.close()
+            self.connect()
+        if timeout_ms != self.statement_timeout_ms:
+            self.cursor.execute("SET statement_timeout = %s", (timeout_ms,))
+            self.statement_timeout_ms = timeout_ms
+
+
+class SqlUser(User):
+    wait_time = between(1, 5)
+
+    def on_start(self):
+        """ on_start is called when a Locust start before any task is scheduled """
+        self.targets = []
+        try:
+            for name, secret_name in get_targets():
+                self.targets.append(DbTarget(name, get_secret(secret_name)))
+        except Exception:
+            # Don't leak the connections already opened to earlier targets
+            for target in self.targets:
+                target.close()
+            self.targets = []
+            raise
+        self.iteration = 0
+
         # Load queries from the 'queries' directory
-        self.queries = []
-        queries_to_run = os.environ.get("QUERIES_TO_RUN")
-        if queries_to_run:
-            selected_queries = queries_to_run.split(",")
-            for filename in selected_queries:
-                with open(os.path.join("queries", filename), 'r') as f:
-                    self.queries.append((filename, f.read()))
-        else:
-            for filename in os.listdir("queries"):
-                if filename.endswith(".sql"):
-                    with open(os.path.join("queries", filename), 'r') as f:
-                        self.queries.append((filename, f.read()))
+        self.queries = load_queries()
 
     def on_stop(self):
         """ on_stop is called when the TaskSet is stopping """
-        if self.connection:
-            self.cursor.close()
-            self.connection.close()
+        for target in self.targets:
+            target.close()
+        self.targets = []
+
+    def fire_request(self, request_type, target, filename, start_time, exception=None):
+        total_time = int((time.time() - start_time) * 1000)
+        self.environment.events.request.fire(
+            request_type=request_type,
+            name=request_name(target.name, filename),
+            response_time=total_time,
+            response_length=0,
+            exception=exception,
+            context={"target": target.name, "query": filename},
+        )
 
     @task
     def execute_query_from_file(self):
@@ -47,25 +234,30 @@ class SqlUser(User):
             return
 
         filename, query = random.choice(self.queries)
-        
+        timeout_ms = QUERY_TIMEOUTS.get(filename, STATEMENT_TIMEOUT_MS)
+
+        # Run the same query against every target, rotating the order so that
+        # no target is consistently first (or last) under the same load.
+        offset = self.iteration % len(self.targets)
+        self.iteration += 1
+        for target in self.targets[offset:] + self.targets[:offset]:
+            self.execute_query(target, filename, query, timeout_ms)
+
+    def execute_query(self, target, filename, query, timeout_ms):
+        client_timeout = (timeout_ms + CLIENT_TIMEOUT_GRACE_MS) / 1000 if timeout_ms > 0 else None
+
+        metrics_exporter.in_flight[(target.name, filename)] += 1
         start_time = time.time()
         try:
-            self.cursor.execute(query)
-            self.cursor.fetchone()
-            total_time = int((time.time() - start_time) * 1000)
-            self.environment.events.request.fire(
-                request_type="sql",
-                name=filename, # Use the filename as the name
-                response_time=total_time,
-                response_length=0,
-                exception=None,
-            )
+            target.set_statement_timeout(timeout_ms)
+            with gevent.Timeout(client_timeout):
+                target.cursor.execute(query)
+                target.cursor.fetchone()
+            self.fire_request("sql", target, filename, start_time)
+        except (gevent.Timeout, extensions.QueryCanceledError, CancelTimeoutError) as e:
+            # Timeouts get their own stats entry so they don't skew the sql latencies
+            self.fire_request("timeout", target, filename, start_time, exception=e)
         except Exception as e:
-            total_time = int((time.time() - start_time) * 1000)
-            self.environment.events.request.fire(
-                request_type="sql",
-                name=filename, # Use the filename as the name
-                response_time=total_time,
-                response_length=0,
-                exception=e,
-            )
\ No newline at end of file
+            self.fire_request("sql", target, filename, start_time, exception=e)
+        finally:
+            metrics_exporter.in_flight[(target.name, filename)] -= 1
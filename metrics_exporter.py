@@ -0,0 +1,156 @@
+from bisect import bisect_left
+from collections import defaultdict
+from gevent.pywsgi import WSGIServer
+from locust.runners import STATE_MISSING
+from prometheus_client import CollectorRegistry, make_wsgi_app
+from prometheus_client.utils import floatToGoString
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from utils import split_request_name
+
+# Latency buckets in seconds, wide enough for both select_1.sql and the heavy analytic queries
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Gauges and latency histograms kept by this process; the hot path only touches these
+in_flight = defaultdict(int)  # (target, query file) -> statements currently executing
+open_connections = defaultdict(int)  # target -> open connections
+# (target, query, type) -> per-bucket counts (last one is +Inf) followed by the sum in seconds
+latency_histograms = {}
+
+# Reports from each worker, summed on the master at scrape time
+worker_reports = {}
+
+
+def connection_opened(target):
+    open_connections[target] += 1
+
+
+def connection_closed(target):
+    open_connections[target] -= 1
+
+
+def on_request(request_type, name, response_time, context=None, **kwargs):
+    """ Records the exact response time; Locust's own stats round it above 100ms """
+    if context and "target" in context:
+        key = (context["target"], context["query"], request_type)
+    else:
+        key = split_request_name(name) + (request_type,)
+    histogram = latency_histograms.get(key)
+    if histogram is None:
+        histogram = latency_histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+    seconds = response_time / 1000
+    histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+
+def local_report():
+    """Returns this process' gauges and histograms in the shape workers send to the master."""
+    return {
+        # msgpack can't carry tuple keys, so keyed values travel as flat lists
+        "in_flight": [[target, query, count] for (target, query), count in in_flight.items()],
+        "open_connections": [[target, count] for target, count in open_connections.items()],
+        "latency": [list(key) + histogram for key, histogram in latency_histograms.items()],
+    }
+
+
+def on_report_to_master(client_id, data):
+    """ Worker side: piggyback the gauges and histograms on Locust's regular stats report """
+    data["zersql_metrics"] = local_report()
+
+
+def on_worker_report(client_id, data):
+    """ Master side: remember the latest report from each worker """
+    if "zersql_metrics" in data:
+        worker_reports[client_id] = data["zersql_metrics"]
+
+
+class LocustStatsCollector:
+    """Builds metrics at scrape time from Locust's worker-aggregated stats and the reported histograms."""
+
+    def __init__(self, environment):
+        self.environment = environment
+
+    def collect(self):
+        requests = CounterMetricFamily("zersql_sql_requests", "SQL executions per query file.", labels=["target", "query", "type"])
+        failures = CounterMetricFamily("zersql_sql_failures", "Failed SQL executions per query file.", labels=["target", "query", "type"])
+        latency = HistogramMetricFamily("zersql_sql_response_time_seconds", "SQL response time per query file.", labels=["target", "query", "type"])
+
+        for entry in self.environment.runner.stats.entries.values():
+            labels = list(split_request_name(entry.name)) + [entry.method]
+            requests.add_metric(labels, entry.num_requests)
+            failures.add_metric(labels, entry.num_failures)
+
+        self.drop_lost_workers()
+        local = local_report()
+        reports = [local] + list(worker_reports.values())
+
+        histogram_totals = {}
+        for report in reports:
+            for row in report["latency"]:
+                key, histogram = tuple(row[:3]), row[3:]
+                totals = histogram_totals.setdefault(key, [0] * len(histogram))
+                for i, value in enumerate(histogram):
+                    totals[i] += value
+        for key, histogram in sorted(histogram_totals.items()):
+            latency.add_metric(list(key), self.histogram_buckets(histogram[:-1]), histogram[-1])
+
+        yield requests
+        yield failures
+        yield latency
+
+        gauges = [local] + [report for report in worker_reports.values() if "in_flight" in report]
+        in_flight_totals = defaultdict(int)
+        for report in gauges:
+            for target, query, count in report["in_flight"]:
+                in_flight_totals[(target, query)] += count
+
+        in_flight_metric = GaugeMetricFamily("zersql_sql_in_flight", "SQL statements currently executing.", labels=["target", "query"])
+        for (target, query), count in sorted(in_flight_totals.items()):
+            in_flight_metric.add_metric([target, query], count)
+        yield in_flight_metric
+
+        # Each simulated user holds one connection per target, so the "pool" is open vs busy connections
+        connections = GaugeMetricFamily("zersql_db_connections", "Load-test database connections.", labels=["target", "state"])
+        open_totals = defaultdict(int)
+        for report in gauges:
+            for target, count in report["open_connections"]:
+                open_totals[target] += count
+        busy_totals = defaultdict(int)
+        for (target, query), count in in_flight_totals.items():
+            busy_totals[target] += count
+        for target in sorted(set(open_totals) | set(busy_totals)):
+            connections.add_metric([target, "open"], open_totals[target])
+            connections.add_metric([target, "busy"], busy_totals[target])
+        yield connections
+
+        yield GaugeMetricFamily("zersql_users", "Simulated users currently running.", value=self.environment.runner.user_count)
+
+    def drop_lost_workers(self):
+        """Forgets the gauges of workers that quit or went missing; their histograms are kept."""
+        clients = getattr(self.environment.runner, "clients", {})
+        for client_id, report in worker_reports.items():
+            client = clients.get(client_id)
+            if client is None or client.state == STATE_MISSING:
+                report.pop("in_flight", None)
+                report.pop("open_connections", None)
+
+    @staticmethod
+    def histogram_buckets(counts):
+        """Turns per-bucket counts into cumulative Prometheus buckets."""
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + [float("inf")], counts):
+            cumulative += count
+            # Canonical float labels ('1.0', '+Inf'), as prometheus_client and OpenMetrics expect
+            buckets.append((floatToGoString(bound), cumulative))
+        return buckets
+
+
+def start_exporter(environment, port):
+    """Serves the metrics (Prometheus text or OpenMetrics, by Accept header) on a gevent server."""
+    registry = CollectorRegistry()
+    registry.register(LocustStatsCollector(environment))
+    environment.events.worker_report.add_listener(on_worker_report)
+
+    server = WSGIServer(("", port), make_wsgi_app(registry), log=None)
+    server.start()
+    return server
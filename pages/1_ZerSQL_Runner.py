@@ -5,9 +5,10 @@ import subprocess
 import time
 import requests
 import psycopg2
-from utils import get_secret
+from utils import get_secret, get_targets, terminate_orphaned_backends, application_name_for, split_request_name
 
 import csv
+import uuid
 from datetime import datetime
 
 def save_test_history(queries, num_users, spawn_rate, run_time):
@@ -76,7 +77,7 @@ def parse_run_time(time_str):
     except:
         return 0
 
-def send_process(selected_queries, num_users, spawn_rate, run_time):
+def send_process(selected_queries, num_users, spawn_rate, run_time, statement_timeout=0, query_timeouts=None, targets=""):
     st.session_state.test_running = True
     
     # Calculate duration for timer
@@ -99,6 +100,14 @@ def send_process(selected_queries, num_users, spawn_rate, run_time):
         return
 
     env["QUERIES_TO_RUN"] = ",".join(selected_queries)
+    # Tags this run's connections so stopping it never touches another run's backends
+    st.session_state.run_id = uuid.uuid4().hex
+    env["ZERSQL_RUN_ID"] = st.session_state.run_id
+    env["STATEMENT_TIMEOUT_MS"] = str(statement_timeout)
+    if query_timeouts:
+        env["QUERY_TIMEOUTS"] = ",".join(f"{name}={ms}" for name, ms in query_timeouts.items())
+    env["TARGETS"] = targets.strip()
+    st.session_state.run_targets = env["TARGETS"]
 
     locust_command = [
         "locust",
@@ -160,6 +169,15 @@ def stop_process():
                 st.session_state.locust_stderr = f.read()
         except Exception as e:
             st.session_state.locust_stderr = f"Error reading logs: {e}"
+
+        # Terminating Locust doesn't stop queries already running on the server
+        for name, secret_name in get_targets(st.session_state.get("run_targets")):
+            try:
+                terminated = terminate_orphaned_backends(get_secret(secret_name), application_name_for(st.session_state.get("run_id")))
+                if terminated:
+                    st.sidebar.info(f"Terminated {terminated} orphaned database backend(s) on {name}.")
+            except Exception as e:
+                st.sidebar.warning(f"Could not terminate orphaned backends on {name}: {e}")
             
         st.session_state.locust_process = None
         st.session_state.test_running = False
@@ -173,6 +191,35 @@ def stop_process():
         st.sidebar.warning("No test is currently running.")
 
 
+def show_target_comparison(stats_df):
+    """Shows per-query results side by side when the run compared several targets."""
+    named_df = stats_df[stats_df["Name"] != "Aggregated"].copy()
+    if named_df.empty:
+        return
+
+    named_df[["Target", "Query"]] = pd.DataFrame(named_df["Name"].apply(split_request_name).tolist(), index=named_df.index)
+    if named_df["Target"].nunique() < 2:
+        return
+
+    # Timed-out executions are reported under their own type, so count them per target
+    # instead of letting a target that mostly times out look fast and failure-free
+    timeouts_df = named_df[named_df["Type"] == "timeout"][["Query", "Target", "Request Count"]].rename(columns={"Request Count": "Timeouts"})
+    compared_df = named_df[named_df["Type"] == "sql"].merge(timeouts_df, on=["Query", "Target"], how="outer")
+    compared_df["Timeouts"] = compared_df["Timeouts"].fillna(0).astype(int)
+
+    st.subheader("🆚 Target Comparison")
+    st.caption(
+        "Latency and failure columns exclude timed-out executions, which are counted under Timeouts. "
+        "Each user runs every query against all targets in turn, so throughput is shared and not compared."
+    )
+    avg_df = compared_df.pivot(index="Query", columns="Target", values="Average Response Time")
+    st.bar_chart(avg_df, use_container_width=True)
+
+    metrics = ["Average Response Time", "95%", "Failure Count", "Timeouts"]
+    comparison_df = compared_df.pivot(index="Query", columns="Target", values=[m for m in metrics if m in compared_df.columns])
+    st.dataframe(comparison_df, use_container_width=True)
+
+
 def get_stats():
     # Try to load and display results
     stats_files_exist = os.path.exists("stats_stats.csv") and os.path.exists("stats_stats_history.csv")
@@ -182,11 +229,15 @@ def get_stats():
             stats_df = pd.read_csv("stats_stats.csv")
             stats_history_df = pd.read_csv("stats_stats_history.csv")
             
+            # Timed-out executions are reported under their own request type
+            timeouts_df = stats_df[stats_df["Type"] == "timeout"] if "Type" in stats_df.columns else stats_df.iloc[0:0]
+
             # Highlight slow queries
             if not stats_df.empty:
                 st.subheader("🐢 Slowest Queries (Current Test)")
-                # Filter out Aggregated and sort by Average Response Time
-                slow_queries = stats_df[stats_df["Name"] != "Aggregated"].sort_values(by="Average Response Time", ascending=False).head(5)
+                # Filter out Aggregated and timeouts, and sort by Average Response Time
+                completed_df = stats_df[(stats_df["Name"] != "Aggregated") & ~stats_df.index.isin(timeouts_df.index)]
+                slow_queries = completed_df.sort_values(by="Average Response Time", ascending=False).head(5)
                 
                 # Show as cards or a simplified table
                 cols = st.columns(len(slow_queries) if len(slow_queries) > 0 else 1)
@@ -194,6 +245,15 @@ def get_stats():
                     with cols[idx]:
                         st.metric(row["Name"], f"{row['Average Response Time']:.0f}ms", delta=f"{row['Max Response Time']:.0f}ms max", delta_color="off")
 
+            if not timeouts_df.empty:
+                st.subheader("⏱️ Timed-out Queries")
+                st.dataframe(
+                    timeouts_df[["Name", "Request Count", "Average Response Time", "Max Response Time"]].rename(columns={"Request Count": "Timeouts"}),
+                    use_container_width=True
+                )
+
+            show_target_comparison(stats_df)
+
             st.subheader("Current Statistics")
             st.dataframe(stats_df, use_container_width=True)
             
@@ -341,6 +401,33 @@ def main():
         disabled=st.session_state.test_running
     )
 
+    # Statement timeouts (enforced server-side, with a client-side cancel as backstop)
+    statement_timeout = st.sidebar.number_input(
+        "Statement Timeout (ms, 0 = none)",
+        min_value=0, value=int(os.environ.get("STATEMENT_TIMEOUT_MS", "0")), step=500,
+        disabled=st.session_state.test_running,
+        help="Queries running longer than this are cancelled and counted as timeouts."
+    )
+    query_timeouts = {}
+    with st.sidebar.expander("Per-query Timeouts"):
+        for query_name in selected_queries:
+            query_timeout = st.number_input(
+                query_name,
+                min_value=0, value=int(statement_timeout), step=500,
+                key=f"timeout_{query_name}",
+                disabled=st.session_state.test_running
+            )
+            if query_timeout != statement_timeout:
+                query_timeouts[query_name] = int(query_timeout)
+
+    # Comparative runs: the same query mix against several endpoints
+    targets = st.sidebar.text_input(
+        "Targets (name=secret, ...)",
+        os.environ.get("TARGETS", ""),
+        disabled=st.session_state.test_running,
+        help="Leave empty to test SECRET_NAME only. E.g. primary=prod-clone-secret,replica=replica-secret"
+    )
+
     # Start and Stop buttons side-by-side
     b_col1, b_col2 = st.sidebar.columns(2)
     
@@ -348,7 +435,7 @@ def main():
         st.button(
             "Start Test", 
             on_click=send_process, 
-            args=(selected_queries, num_users, spawn_rate, run_time),
+            args=(selected_queries, num_users, spawn_rate, run_time, int(statement_timeout), query_timeouts, targets),
             disabled=st.session_state.test_running,
             use_container_width=True
         )
@@ -77,6 +77,51 @@ def get_rds_metrics(instance_id):
         st.error(f"Error fetching CloudWatch metrics: {e}")
         return pd.DataFrame()
 
+# --- Database Activity Functions ---
+
+def get_activity_samples(activity_file="stats_activity.csv"):
+    """Loads the average-active-sessions time series sampled during the last run."""
+    if not os.path.exists(activity_file):
+        return pd.DataFrame()
+    try:
+        df = pd.read_csv(activity_file)
+        if df.empty:
+            return df
+        df["Time"] = pd.to_datetime(df["Timestamp"], unit="s")
+        return df
+    except Exception as e:
+        st.error(f"Error loading database activity samples: {e}")
+        return pd.DataFrame()
+
+def show_activity_samples(activity_df):
+    """Charts average active sessions by wait class and by query file."""
+    # Idle buckets are saved with an empty wait class: they count towards the
+    # run-level averages and keep the charts at 0, but aren't a series themselves
+    all_times = activity_df["Time"].drop_duplicates().sort_values()
+    buckets = len(all_times)
+    active_df = activity_df.dropna(subset=["Wait Class"])
+    if active_df.empty:
+        st.info("No active sessions were sampled during the last run.")
+        return
+
+    # Average per wait class over the run tells whether contention or I/O dominates
+    by_wait_class = active_df.groupby("Wait Class")["Average Active Sessions"].sum()
+    top = (by_wait_class / buckets).sort_values(ascending=False)
+
+    cols = st.columns(min(len(top), 4))
+    for idx, (wait_class, aas) in enumerate(top.head(4).items()):
+        cols[idx].metric(wait_class, f"{aas:.2f} AAS")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.subheader("Active Sessions by Wait Class")
+        st.area_chart(active_df.pivot_table(index="Time", columns="Wait Class", values="Average Active Sessions", aggfunc="sum").reindex(all_times).fillna(0))
+
+    with col2:
+        st.subheader("Active Sessions by Query")
+        st.area_chart(active_df.pivot_table(index="Time", columns="Query", values="Average Active Sessions", aggfunc="sum").reindex(all_times).fillna(0))
+
 # --- CloudWatch Logs Functions ---
 
 def get_rds_logs(instance_id, log_type='error'):
@@ -166,6 +211,18 @@ def main():
     else:
         st.warning("No metrics found in CloudWatch. Ensure the RDS instance is active and reporting.")
 
+    # --- Database Activity Section ---
+    st.divider()
+    st.header("Database Activity (Last Test Run)")
+    st.caption("Average active sessions sampled from pg_stat_activity and pg_locks while the test was running.")
+
+    activity_df = get_activity_samples()
+
+    if not activity_df.empty:
+        show_activity_samples(activity_df)
+    else:
+        st.info("No activity samples yet. Run a test in the ZerSQL Runner page to collect them.")
+
     if st.session_state.auto_refresh:
         time.sleep(30)
         st.rerun()
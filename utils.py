@@ -1,6 +1,14 @@
 import boto3
 import json
 import os
+import psycopg2
+
+def application_name_for(run_id=None):
+    """Returns the application_name tagging one run's connections, so its backends can be found in pg_stat_activity."""
+    return f"zersql-locust-{run_id}" if run_id else "zersql-locust"
+
+# The Runner passes ZERSQL_RUN_ID to Locust (and its workers) through the environment
+APPLICATION_NAME = application_name_for(os.environ.get("ZERSQL_RUN_ID"))
 
 def get_aws_client(service_name):
     region_name = os.environ.get("AWS_REGION", "us-east-1")
@@ -28,8 +36,8 @@ def get_aws_client(service_name):
         
     return session.client(**client_kwargs)
 
-def get_secret():
-    secret_name = os.environ.get("SECRET_NAME")
+def get_secret(secret_name=None):
+    secret_name = secret_name or os.environ.get("SECRET_NAME")
     client = get_aws_client('secretsmanager')
 
     get_secret_value_response = client.get_secret_value(
@@ -38,3 +46,65 @@ def get_secret():
     
     secret = get_secret_value_response['SecretString']
     return json.loads(secret)
+
+# Target name used when TARGETS is not set and only SECRET_NAME is tested
+DEFAULT_TARGET = "default"
+
+def get_targets(value=None):
+    """Returns the (name, secret name) pairs to test, from TARGETS='primary=secret,replica=other-secret' or SECRET_NAME."""
+    if value is None:
+        value = os.environ.get("TARGETS")
+    targets = []
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        name, secret_name = item.split("=", 1)
+        targets.append((name.strip(), secret_name.strip()))
+    return targets or [(DEFAULT_TARGET, os.environ.get("SECRET_NAME"))]
+
+def request_name(target, filename):
+    """Names a request 'target/query.sql', or just 'query.sql' for the default single target."""
+    return filename if target == DEFAULT_TARGET else f"{target}/{filename}"
+
+def split_request_name(name):
+    """Inverse of request_name: returns (target, query file). Query files never contain '/'."""
+    target, _, query = name.rpartition("/")
+    return target or DEFAULT_TARGET, query
+
+def parse_query_timeouts(value):
+    """Parses a 'file.sql=5000,other.sql=250' string into a {filename: milliseconds} dict."""
+    timeouts = {}
+    if not value:
+        return timeouts
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        filename, timeout_ms = item.split("=", 1)
+        try:
+            timeouts[filename.strip()] = int(timeout_ms)
+        except ValueError:
+            continue
+    return timeouts
+
+def terminate_orphaned_backends(credentials, application_name=APPLICATION_NAME):
+    """Terminates backends left running by a stopped load test. Returns how many were terminated."""
+    connection = psycopg2.connect(
+        host=credentials['host'],
+        dbname=credentials['dbname'],
+        user=credentials['username'],
+        password=credentials['password'],
+        port=credentials['port']
+    )
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT pg_terminate_backend(pid)
+                FROM pg_stat_activity
+                WHERE application_name = %s AND pid <> pg_backend_pid()
+                """,
+                (application_name,)
+            )
+            return sum(1 for (terminated,) in cursor.fetchall() if terminated)
+    finally:
+        connection.close()